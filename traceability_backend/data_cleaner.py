@@ -1,4 +1,5 @@
-import os, json, time, hashlib
+import os, time, hashlib
+import orjson
 from collections import defaultdict
 from datetime import datetime
 import pika
@@ -12,12 +13,45 @@ MAX_PER_BATCH = 4
 
 # 保持各 batch 的缓存
 batch_cache = defaultdict(list)
-
-def calc_sha256(record: dict) -> str:
-    raw = json.dumps(record, sort_keys=True).encode('utf-8')
-    return hashlib.sha256(raw).hexdigest()
-
-def try_flush_batch(batch_id: str):
+# 各 batch 最后一条消息的 delivery_tag：
+# 攒到打包时用 multiple=True 一帧确认整批，而不是每条回一个 ack 帧
+batch_tags = {}
+# 各 batch 的 Merkle 层缓存：levels[0] 是叶子，levels[1] 是两两配对的哈希……
+# 消息到达时就顺带把能配对的层算掉，打包时只剩顶上 log2(N) 层
+batch_levels = defaultdict(list)
+
+def calc_sha256(payload: dict) -> bytes:
+    # 字段顺序写死，直接按序喂 hashlib：
+    # 省掉 sort_keys 的字典排序和 json.dumps 的中间字符串。
+    # 返回原始 digest，hex 只在写 JSON 时转一次
+    h = hashlib.sha256()
+    h.update(payload['ts'].encode())
+    h.update(b'|')
+    h.update(f"{payload['temp']:.4f}".encode())
+    h.update(b'|')
+    h.update(f"{payload['hum']:.4f}".encode())
+    h.update(b'|')
+    h.update(payload['location'].encode())
+    h.update(b'|')
+    h.update(payload['productName'].encode())
+    return h.digest()
+
+def add_leaf_hash(batch_id: str, leaf: bytes):
+    """把新叶子挂进层缓存，凑齐一对就向上链式合并（摊还 O(1)）。
+    层缓存全程存 bytes，不来回做 hex 转换"""
+    levels = batch_levels[batch_id]
+    h = leaf
+    lvl = 0
+    while True:
+        if lvl == len(levels):
+            levels.append([])
+        levels[lvl].append(h)
+        if len(levels[lvl]) % 2:
+            break
+        h = hashlib.sha256(levels[lvl][-2] + levels[lvl][-1]).digest()
+        lvl += 1
+
+def try_flush_batch(ch, batch_id: str):
     """当缓存量够或定时到达，就写文件并清空缓存"""
     records = batch_cache[batch_id]
     if len(records) >= MAX_PER_BATCH:
@@ -26,17 +60,27 @@ def try_flush_batch(batch_id: str):
         os.makedirs(BATCH_DIR, exist_ok=True)
         path = os.path.join(BATCH_DIR, filename)
 
-        # 写入文件
-        with open(path, 'w', encoding='utf-8') as f:
-            json.dump(records, f, indent=2)
+        # 写入文件（叶子层就是记录自带的 hash，不重复写）
+        # JSON 边界上才把 bytes 转成 hex，各转恰好一次
+        batch = {
+            'records': records,
+            'precomputed_levels': [[h.hex() for h in lvl]
+                                   for lvl in batch_levels[batch_id][1:]],
+        }
+        with open(path, 'wb') as f:
+            f.write(orjson.dumps(batch, option=orjson.OPT_INDENT_2))
         print(f'[Batch Written] {path} ({len(records)} records)')
 
+        # 文件落盘成功后再一次性确认到最后一条
+        ch.basic_ack(delivery_tag=batch_tags.pop(batch_id), multiple=True)
+
         # 清空缓存
         batch_cache[batch_id].clear()
+        batch_levels[batch_id].clear()
 
 def on_message(ch, method, properties, body):
     try:
-        payload = json.loads(body)
+        payload = orjson.loads(body)
         routing_key = method.routing_key  # e.g. coldchain/batch123/sensor
         # 解析 batch_id
         batch_id = routing_key.split('/')[1]
@@ -48,7 +92,8 @@ def on_message(ch, method, properties, body):
             return ch.basic_ack(delivery_tag=method.delivery_tag)
         # 时间戳可加更严格校验...
 
-        # 计算哈希并加入记录
+        # 计算哈希并加入记录（内部传 bytes，JSON 里存 hex）
+        digest = calc_sha256(payload)
         record = {
             'batch_id': batch_id,
             'ts': payload['ts'],
@@ -56,18 +101,18 @@ def on_message(ch, method, properties, body):
             'hum': payload['hum'],
             'location': payload['location'],
             'productName': payload['productName'],
-            'hash': calc_sha256(payload)
+            'hash': digest.hex()
         }
         batch_cache[batch_id].append(record)
+        add_leaf_hash(batch_id, digest)
+        # 只记 tag，ack 留到打包时批量发
+        batch_tags[batch_id] = method.delivery_tag
 
         # 条件满足则打包
-        try_flush_batch(batch_id)
-
-        # 确认消息
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+        try_flush_batch(ch, batch_id)
     except Exception as e:
         print('Cleaner error:', e)
-        ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+        ch.basic_nack(delivery_tag=method.delivery_tag, multiple=True, requeue=False)
 
 def main():
     params = pika.URLParameters(RABBITMQ_URL)
@@ -80,7 +125,10 @@ def main():
     queue_name = result.method.queue
     channel.queue_bind(exchange=RAW_EXCHANGE, queue=queue_name, routing_key='#')
 
-    channel.basic_qos(prefetch_count=10)
+    # ack 攒到整批才发，每个 batch_id 最多压着 MAX_PER_BATCH-1 条未确认
+    # 消息；预取必须远大于 并发批次数 × (MAX_PER_BATCH-1)，否则多个
+    # 批次交错时 broker 会在凑不齐任何一批前就停止投递，流水线卡死
+    channel.basic_qos(prefetch_count=200)
     channel.basic_consume(queue=queue_name, on_message_callback=on_message)
 
     print('Data Cleaner waiting for messages...')
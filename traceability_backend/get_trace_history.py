@@ -3,7 +3,7 @@
 
 import os
 import json
-import datetime
+import numpy as np
 from web3 import Web3
 from dotenv import load_dotenv
 
@@ -42,26 +42,21 @@ def main():
     # 确保它们长度一致
     n = len(tss)
     print(f"共 {n} 条记录\n")
-    for i in range(n):
-        ts = tss[i]
-        try:
-            dt = datetime.datetime.fromtimestamp(ts)
-            ts_str = dt.strftime("%Y-%m-%d %H:%M:%S")
-        except:
-            ts_str = str(ts)
-        temp = temps[i]
-        hum  = hums[i]
-        loc  = locations[i]
-        name = product_names[i]
-        dh   = data_hashes[i].hex()
 
+    # 时间戳 / 温湿度整批在 NumPy 里转好，循环里只做取值
+    dts = np.array(tss, dtype='datetime64[s]')
+    ts_strs = np.char.replace(np.datetime_as_string(dts, unit='s'), 'T', ' ')
+    temps_f = np.asarray(temps) / 100
+    hums_f  = np.asarray(hums) / 100
+
+    for i in range(n):
         print(f"记录 {i+1}:")
-        print(f"  时间戳: {ts} ({ts_str})")
-        print(f"  温度: {temp/100}℃")
-        print(f"  湿度: {hum/100}")
-        print(f"  位置: {loc}")
-        print(f"  产品名称: {name}")
-        print(f"  数据哈希: {dh}")
+        print(f"  时间戳: {tss[i]} ({ts_strs[i]})")
+        print(f"  温度: {temps_f[i]}℃")
+        print(f"  湿度: {hums_f[i]}")
+        print(f"  位置: {locations[i]}")
+        print(f"  产品名称: {product_names[i]}")
+        print(f"  数据哈希: {data_hashes[i].hex()}")
         print("-" * 40)
 
 if __name__ == "__main__":
@@ -1,73 +1,209 @@
-import json
-import datetime
-import os
-from web3 import Web3
-from dotenv import load_dotenv
-
-# —— 1. 加载环境 & 初始化 Web3 ——
-load_dotenv()
-RPC   = os.getenv("WEB3_RPC_URL")
-KEY   = os.getenv("PRIVATE_KEY")
-ADDR  = Web3.to_checksum_address(os.getenv("CONTRACT_ADDRESS"))
-ABI   = json.load(open(os.getenv("ABI_PATH"), 'r'))
-
-w3      = Web3(Web3.HTTPProvider(RPC))
-acct    = w3.eth.account.from_key(KEY)
-contract = w3.eth.contract(address=ADDR, abi=ABI)
-
-
-def to_unix(ts_iso: str) -> int:
-    # "2025-07-31T01:56:14Z" → UNIX
-    dt = datetime.datetime.fromisoformat(ts_iso.replace("Z", "+00:00"))
-    return int(dt.timestamp())
-
-
-def send_upload(rec: dict):
-    """将一条 JSON 记录上传到链上"""
-    # 1) 时间戳
-    unix_ts = to_unix(rec["ts"])
-    # 2) 数值转整数（如果想保留两位小数，就 *100）
-    temp_int = int(rec["temp"] * 100)
-    hum_int  = int(rec["hum"]  * 100)
-    # 3) 把 hex hash → bytes32
-    data_hash = Web3.to_bytes(hexstr=rec["hash"])
-    # 4) 构造交易
-    txn = contract.functions.uploadData(
-        rec["batch_id"],   # batchId
-        unix_ts,
-        temp_int,
-        hum_int,
-        rec["location"],
-        rec["productName"],
-        data_hash
-    ).build_transaction({
-        "from":      acct.address,
-        "nonce":     w3.eth.get_transaction_count(acct.address),
-        "gas":       500_000,
-        "gasPrice":  w3.to_wei("20", "gwei"),
-    })
-    # 5) 签名并发送
-    signed = acct.sign_transaction(txn)
-    txh = w3.eth.send_raw_transaction(signed.raw_transaction)
-    receipt = w3.eth.wait_for_transaction_receipt(txh)
-    if receipt.status == 0:
-        print("❌ 交易失败，revert 了")
-        return
-    print(f"✅ 上链完成，txHash={receipt.transactionHash.hex()}")
-    print("Chain ID:", w3.eth.chain_id)
-
-
-if __name__ == "__main__":
-    # —— 2. 读取 JSON 文件 ——
-    with open("batches/batch321_20250731T020929Z.json", "r", encoding="utf-8") as f:
-        data = json.load(f)
-
-    # 如果文件里是一条记录：
-    if isinstance(data, dict):
-        send_upload(data)
-    # 如果是记录列表：
-    elif isinstance(data, list):
-        for rec in data:
-            send_upload(rec)
-    else:
-        raise ValueError("Unsupported JSON structure")
\ No newline at end of file
+import calendar
+import json
+import datetime
+import os
+import re
+import threading
+import time
+from web3 import Web3
+from web3.exceptions import TransactionNotFound
+from dotenv import load_dotenv
+
+# —— 1. 加载环境 & 初始化 Web3 ——
+load_dotenv()
+RPC   = os.getenv("WEB3_RPC_URL")
+KEY   = os.getenv("PRIVATE_KEY")
+ADDR  = Web3.to_checksum_address(os.getenv("CONTRACT_ADDRESS"))
+ABI   = json.load(open(os.getenv("ABI_PATH"), 'r'))
+
+w3      = Web3(Web3.HTTPProvider(RPC))
+acct    = w3.eth.account.from_key(KEY)
+contract = w3.eth.contract(address=ADDR, abi=ABI)
+
+# 固定参数只查一次，避免每条记录都走一遍 RPC
+GAS_PRICE = w3.to_wei("20", "gwei")
+CHAIN_ID  = w3.eth.chain_id
+
+# nonce 本地缓存：首次从链上读 pending 值，之后每发一条 +1，
+# 省掉每条记录一次 get_transaction_count 往返，也允许多条未打包交易排队
+_nonce_lock    = threading.Lock()
+_nonce         = None
+_needs_refresh = False
+
+# 热路径不再逐条 wait 回执，先记下来，结束时统一轮询
+_pending_receipts = []
+# 整体等回执的上限，和 wait_for_transaction_receipt 的默认超时一致
+RECEIPT_TIMEOUT = 120
+
+
+def _reserve_nonces(count: int = 1) -> int:
+    """占用 count 个连续 nonce，返回起始值"""
+    global _nonce, _needs_refresh
+    with _nonce_lock:
+        if _nonce is None or _needs_refresh:
+            _nonce = w3.eth.get_transaction_count(acct.address, "pending")
+            _needs_refresh = False
+        start = _nonce
+        _nonce += count
+        return start
+
+
+def _mark_nonce_stale():
+    global _needs_refresh
+    with _nonce_lock:
+        _needs_refresh = True
+
+
+# 传感器时间戳都是固定的 "2025-07-31T01:56:14Z" 形式，
+# 正则拆字段 + timegm 比每条构造一个 datetime 对象快得多
+_ISO = re.compile(r'(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})Z')
+
+def to_unix(ts_iso: str) -> int:
+    # "2025-07-31T01:56:14Z" → UNIX
+    m = _ISO.match(ts_iso)
+    if m:
+        return calendar.timegm((int(m[1]), int(m[2]), int(m[3]),
+                                int(m[4]), int(m[5]), int(m[6]), 0, 0, 0))
+    # 其他写法（带时区偏移等）走原来的慢路径
+    dt = datetime.datetime.fromisoformat(ts_iso.replace("Z", "+00:00"))
+    return int(dt.timestamp())
+
+
+# 一个批次里逐条不变的字段做成模板，热路径只补 nonce 和 data
+_TX_TEMPLATE = {
+    "from":      acct.address,
+    "to":        ADDR,
+    "gas":       500_000,
+    "gasPrice":  GAS_PRICE,
+    "chainId":   CHAIN_ID,
+    "value":     0,
+}
+
+
+def make_tx_builder():
+    """把常量模板和编码/签名函数闭包进一个专用构造器（部分求值），
+    每条记录只剩变量字段的工作"""
+    template = _TX_TEMPLATE
+    encode = contract.encode_abi
+    sign = acct.sign_transaction
+
+    def build_signed(rec: dict, nonce: int):
+        """用指定 nonce 构造并签名一条上传交易，返回 raw_transaction 字节"""
+        # 1) 时间戳
+        unix_ts = to_unix(rec["ts"])
+        # 2) 数值转整数（如果想保留两位小数，就 *100）
+        temp_int = int(rec["temp"] * 100)
+        hum_int  = int(rec["hum"]  * 100)
+        # 3) 把 hex hash → bytes32
+        data_hash = Web3.to_bytes(hexstr=rec["hash"])
+        # 4) 直接 ABI 编码 calldata、手拼交易字典，
+        #    不走 build_transaction（它每次都重新做 ABI 校验，
+        #    还可能偷偷补发 eth_estimateGas / eth_chainId RPC）
+        data = encode('uploadData', args=(
+            rec["batch_id"],   # batchId
+            unix_ts,
+            temp_int,
+            hum_int,
+            rec["location"],
+            rec["productName"],
+            data_hash,
+        ))
+        # 5) 签名
+        return sign({**template, "nonce": nonce, "data": data}).raw_transaction
+
+    return build_signed
+
+
+build_signed = make_tx_builder()
+
+
+def _is_nonce_error(err: Exception) -> bool:
+    msg = str(err).lower()
+    return ("nonce too low" in msg or "nonce too high" in msg
+            or "replacement transaction underpriced" in msg)
+
+
+def send_upload(rec: dict):
+    """将一条 JSON 记录上传到链上（回执延后统一轮询）"""
+    nonce = _reserve_nonces()
+    raw = build_signed(rec, nonce)
+    try:
+        txh = w3.eth.send_raw_transaction(raw)
+    except Exception as e:
+        if _is_nonce_error(e):
+            # 下次调用先从链上重新读 nonce
+            _mark_nonce_stale()
+        raise
+    _pending_receipts.append(txh)
+    print(f"📤 已发送，txHash={txh.hex()}")
+
+
+def flush_receipts():
+    """轮询所有已发送交易的回执，最多等 RECEIPT_TIMEOUT 秒"""
+    # 没打包的交易 get_transaction_receipt 会抛 TransactionNotFound
+    # （batch 里同样会抛，所以这里逐条查、逐条接异常）
+    pending = dict(enumerate(_pending_receipts))
+    deadline = time.monotonic() + RECEIPT_TIMEOUT
+    while pending:
+        for i, h in list(pending.items()):
+            try:
+                receipt = w3.eth.get_transaction_receipt(h)
+            except TransactionNotFound:
+                continue  # 还没打包，下一轮再查
+            if receipt.status == 0:
+                print(f"❌ 交易失败，revert 了，txHash={receipt.transactionHash.hex()}")
+            else:
+                print(f"✅ 上链完成，txHash={receipt.transactionHash.hex()}")
+            del pending[i]
+        if pending:
+            if time.monotonic() >= deadline:
+                for h in pending.values():
+                    print(f"⏰ 等待回执超时，txHash={h.hex()}")
+                break
+            time.sleep(1)
+    _pending_receipts.clear()
+
+
+def send_batch(records: list):
+    """批量上链：nonce 只读一次、本地递增，逐条发送，回执延后统一轮询"""
+    # eth_sendRawTransaction 不允许进 JSON-RPC batch（web3.py 会抛
+    # MethodNotSupported），所以发送只能逐条来；好在 nonce 缓存和
+    # 延后回执已经把每条的另外两次往返省掉了
+    base_nonce = _reserve_nonces(len(records))
+    for i, rec in enumerate(records):
+        raw = build_signed(rec, base_nonce + i)
+        try:
+            _pending_receipts.append(w3.eth.send_raw_transaction(raw))
+        except Exception as e:
+            if not _is_nonce_error(e):
+                print(f"❌ 第 {i+1} 条发送失败: {e}")
+                continue
+            # nonce 冲突：刷新后只重发这一条
+            _mark_nonce_stale()
+            raw = build_signed(rec, _reserve_nonces())
+            try:
+                _pending_receipts.append(w3.eth.send_raw_transaction(raw))
+            except Exception as e:
+                print(f"❌ 第 {i+1} 条重发失败: {e}")
+
+
+if __name__ == "__main__":
+    # —— 2. 读取 JSON 文件 ——
+    with open("batches/batch321_20250731T020929Z.json", "r", encoding="utf-8") as f:
+        data = json.load(f)
+
+    # cleaner 新格式：{"records": [...], "precomputed_levels": [...]}
+    if isinstance(data, dict) and "records" in data:
+        data = data["records"]
+
+    # 如果文件里是一条记录：
+    if isinstance(data, dict):
+        send_upload(data)
+    # 如果是记录列表：
+    elif isinstance(data, list):
+        send_batch(data)
+    else:
+        raise ValueError("Unsupported JSON structure")
+
+    # 结束前统一等待回执
+    flush_receipts()
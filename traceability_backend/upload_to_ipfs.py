@@ -1,32 +1,95 @@
-import os, json, hashlib, subprocess
+import os, hashlib, sqlite3
 import mysql.connector
+import orjson
+import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
-# Merkle Root 计算函数同前
-def compute_merkle_root(hash_list):
+# 绑定成模块局部名，热循环里省掉属性查找
+_sha256 = hashlib.sha256
+
+# 跨批次持久化的子树缓存：64 字节的 (left+right) → 32 字节 parent。
+# 追加型负载里相邻批次共享大量子树，命中即省掉整棵子树的重算
+MERKLE_CACHE_PATH = 'merkle_cache.sqlite'
+
+def _open_merkle_cache():
+    conn = sqlite3.connect(MERKLE_CACHE_PATH)
+    conn.execute(
+        'CREATE TABLE IF NOT EXISTS merkle_cache ('
+        ' pair   BLOB PRIMARY KEY,'
+        ' parent BLOB NOT NULL)'
+    )
+    cache = dict(conn.execute('SELECT pair, parent FROM merkle_cache'))
+    return conn, cache
+
+# 多线程下 dict/list 的单次读写有 GIL 保护；并发写入同一对节点最多
+# 重算一次哈希，落盘时 INSERT OR IGNORE 会去重，所以不需要额外加锁
+_merkle_cache_conn, _merkle_cache = _open_merkle_cache()
+_merkle_cache_new = []  # 本次新增的条目，批次处理完后落盘
+
+def flush_merkle_cache():
+    if _merkle_cache_new:
+        _merkle_cache_conn.executemany(
+            'INSERT OR IGNORE INTO merkle_cache VALUES (?, ?)', _merkle_cache_new)
+        _merkle_cache_conn.commit()
+        _merkle_cache_new.clear()
+
+# Merkle Root 计算：叶子 hex 只解码一次，进一个连续缓冲区，
+# 每层直接对 64 字节切片做 sha256，省掉逐节点的列表和 hex 转换。
+# cache 命中时直接取 parent；只缓存 level >= minimum_level_to_cache 的
+# 内部节点（叶子层哈希本身很便宜，不值得占空间）
+def compute_merkle_root(hash_list, cache=None, minimum_level_to_cache=2):
+    """hash_list 的叶子可以是 bytes，也可以是 hex 字符串（只解码一次）"""
     if not hash_list:
         return None
-    current = list(hash_list)
-    while len(current) > 1:
-        if len(current) % 2 == 1:
-            current.append(current[-1])
-        next_level = []
-        for i in range(0, len(current), 2):
-            combined = bytes.fromhex(current[i]) + bytes.fromhex(current[i+1])
-            next_level.append(hashlib.sha256(combined).hexdigest())
-        current = next_level
-    return current[0]
-
-IPFS_CLI_PATH = r"D:\go-ipfs\ipfs.exe"
-
-def upload_file_via_cli(path):
-    result = subprocess.run(
-        [IPFS_CLI_PATH, 'add', '-Q', path],
-        stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
-    )
-    if result.returncode != 0:
-        raise RuntimeError(f"IPFS add failed: {result.stderr}")
-    return result.stdout.strip()
+    # 两块缓冲区开好后整个归约过程轮换复用，不再每层新建列表/数组；
+    # 容量多留一个节点位，奇数层补齐时就地写入
+    cap = 32 * (len(hash_list) + 1)
+    buf = bytearray(cap)
+    if isinstance(hash_list[0], str):
+        buf[:32 * len(hash_list)] = b''.join(bytes.fromhex(h) for h in hash_list)
+    else:
+        buf[:32 * len(hash_list)] = b''.join(hash_list)
+    scratch = bytearray(cap)
+    n = 32 * len(hash_list)  # buf 里有效字节数
+    level = 1  # 本轮产出的节点层级（叶子为 0）
+    while n > 32:
+        if n % 64:
+            buf[n:n + 32] = buf[n - 32:n]  # 奇数个节点：复制最后一个补齐
+            n += 32
+        cacheable = cache is not None and level >= minimum_level_to_cache
+        if cacheable:
+            # 缓存键必须是 bytes，这条路径照旧拷一份
+            for i in range(0, n, 64):
+                pair = bytes(buf[i:i + 64])
+                parent = cache.get(pair)
+                if parent is None:
+                    parent = _sha256(pair).digest()
+                    cache[pair] = parent
+                    _merkle_cache_new.append((pair, parent))
+                scratch[i // 2:i // 2 + 32] = parent
+        else:
+            # memoryview 切片零拷贝直送 OpenSSL，循环里不再产生中间 bytes
+            mv = memoryview(buf)
+            for i in range(0, n, 64):
+                scratch[i // 2:i // 2 + 32] = _sha256(mv[i:i + 64]).digest()
+            mv.release()
+        buf, scratch = scratch, buf
+        n //= 2
+        level += 1
+    return bytes(buf[:32]).hex()
+
+# IPFS HTTP API（go-ipfs daemon 默认端口）。
+# Session 放模块级，keep-alive 复用同一条 TCP 连接，
+# 也不用再为每个文件 fork 一次 ipfs.exe 进程
+IPFS_API_URL = 'http://127.0.0.1:5001/api/v0/add'
+_ipfs_session = requests.Session()
+
+def upload_bytes(raw: bytes, name: str):
+    resp = _ipfs_session.post(IPFS_API_URL, files={'file': (name, raw)})
+    if resp.status_code != 200:
+        raise RuntimeError(f"IPFS add failed: {resp.text}")
+    return resp.json()['Hash']
 
 # MySQL 连接配置
 cfg = {
@@ -38,35 +101,75 @@ cfg = {
     'auth_plugin':  'mysql_native_password'
 }
 
+# 连接池：握手 + 认证只做 pool_size 次，之后各文件复用
+pool = mysql.connector.pooling.MySQLConnectionPool(
+    pool_name='batch_pool', pool_size=8, **cfg)
+
+# 每多少行 commit 一次：一次 fsync 摊给一组行，
+# 又不至于让超大运行攒出过长的事务
+COMMIT_EVERY = 100
+
+def insert_batches(rows):
+    """批次行攒着用 executemany 插，每 COMMIT_EVERY 行才 commit 一次"""
+    if not rows:
+        return
+    cnx = pool.get_connection()
+    cnx.autocommit = False
+    cur = cnx.cursor()
+    for i in range(0, len(rows), COMMIT_EVERY):
+        cur.executemany("""
+            INSERT IGNORE INTO batches
+              (batch_id, ipfs_cid, merkle_root, record_count, created_at)
+            VALUES (%s, %s, %s, %s, %s)
+        """, rows[i:i + COMMIT_EVERY])
+        cnx.commit()
+    cur.close()
+    cnx.close()  # 归还连接池
+
 def process_batch_file(path):
-    # 1. 读取 JSON
-    with open(path, 'r', encoding='utf-8') as f:
-        records = json.load(f)
+    # 1. 文件只读一次：同一份字节既喂 JSON 解析，也直接发给 IPFS，
+    #    不再让 IPFS 那边重读一遍磁盘
+    with open(path, 'rb') as f:
+        raw = f.read()
+    data = orjson.loads(raw)
+    if isinstance(data, dict):
+        records = data['records']
+        precomputed_levels = data.get('precomputed_levels', [])
+    else:
+        records = data
+        precomputed_levels = []
     batch_id = os.path.basename(path).split('_')[0]
 
-    # 2. 计算 Merkle Root
-    merkle_root = compute_merkle_root([rec['hash'] for rec in records])
+    # 2. 计算 Merkle Root：cleaner 已经算好的层能整层覆盖叶子时，
+    #    直接从最高的那层起算，只剩顶部 log2(N) 层要做
+    start_hashes = [rec['hash'] for rec in records]
+    for lvl, hashes in enumerate(precomputed_levels, start=1):
+        if hashes and len(hashes) * (2 ** lvl) == len(records):
+            start_hashes = hashes
+    merkle_root = compute_merkle_root(start_hashes, cache=_merkle_cache)
 
-    # 3. 上传到 IPFS CLI
-    cid = upload_file_via_cli(path)
-    print(f"[IPFS CLI] Batch {batch_id} → CID={cid}, MerkleRoot={merkle_root}")
+    # 3. 上传到 IPFS（直接用上面读到的字节）
+    cid = upload_bytes(raw, os.path.basename(path))
+    print(f"[IPFS] Batch {batch_id} → CID={cid}, MerkleRoot={merkle_root}")
 
-    # 4. 写入 MySQL
-    cnx = mysql.connector.connect(**cfg)
-    cur = cnx.cursor()
-    cur.execute("""
-        INSERT IGNORE INTO batches
-          (batch_id, ipfs_cid, merkle_root, record_count, created_at)
-        VALUES (%s, %s, %s, %s, %s)
-    """, (batch_id, cid, merkle_root, len(records), datetime.utcnow()))
-    cnx.commit()
-    cur.close()
-    cnx.close()
+    # 4. 这一行交给 main 统一批量插入
+    return (batch_id, cid, merkle_root, len(records), datetime.utcnow())
 
 def main():
-    for fname in os.listdir('./batches'):
-        if fname.endswith('.json'):
-            process_batch_file(os.path.join('./batches', fname))
+    paths = [os.path.join('./batches', fname)
+             for fname in os.listdir('./batches') if fname.endswith('.json')]
+    # 每个文件的处理都是 I/O 等待（IPFS HTTP + 读盘），线程池让上传重叠进行。
+    # 单个文件坏了只跳过它自己，成功的批次照常入库、落缓存
+    rows = []
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        futures = {ex.submit(process_batch_file, p): p for p in paths}
+        for fut in as_completed(futures):
+            try:
+                rows.append(fut.result())
+            except Exception as e:
+                print(f"[Skip] {futures[fut]}: {e}")
+    insert_batches(rows)
+    flush_merkle_cache()
 
 if __name__ == '__main__':
     main()